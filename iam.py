@@ -7,10 +7,14 @@ Slack commands for setting work status to notify your team when you're not in th
 
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 import json
 import logging
 import os
+import sys
+import re
 import requests
+import time
 from datetime import datetime, timedelta
 from datetime import time as dt_time
 import math
@@ -18,7 +22,6 @@ import parsedatetime as pdt
 from pytz import timezone
 from zappa.asynchronous import task
 from traceback import format_exc
-import time
 
 from flask import abort, Flask, jsonify, request
 
@@ -51,14 +54,47 @@ help_attachment_text = (
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-dynamo = boto3.resource('dynamodb')
+# Route table reads and writes through DAX when a cluster is configured (requires the
+# amazon-dax-client package). Writes update only DAX's item cache; the query cache
+# used by today/history/schedule stays stale until its TTL expires (5 minutes by default)
+dynamo = None
+if 'DAX_ENDPOINT' in os.environ:
+    try:
+        import amazondax
+    except ImportError:
+        logger.warning('DAX_ENDPOINT is set but amazon-dax-client is not installed; using DynamoDB directly')
+    else:
+        dynamo = amazondax.AmazonDaxClient.resource(endpoint_url=os.environ['DAX_ENDPOINT'])
+if dynamo is None:
+    dynamo = boto3.resource('dynamodb')
 log_table_name = 'slack-iam-log'
+_LOG_TABLE = dynamo.Table(log_table_name)
 
 webhook_url = os.environ['SLACK_WEBHOOK_URL']
 
+# Shared across invocations in a warm container so Slack posts reuse pooled connections
+_SESSION = requests.Session()
+_SESSION.headers.update({'Content-Type': 'application/json'})
+
 app = Flask(__name__)
 
-through_words = [' through ', ' to ', ' thru ']
+_AND_RE = re.compile(r'\s+and\s+', re.IGNORECASE)
+_THROUGH_RE = re.compile(r'\s+(?:through|thru|to)\s+', re.IGNORECASE)
+
+WFH_OOO = frozenset(('wfh', 'ooo'))
+
+_CAL = pdt.Calendar()
+_EASTERN = timezone('US/Eastern')
+_UTC = timezone('UTC')
+
+# Relative dates that the code itself asks for, answered without running the parser
+_FAST_DATES = {
+    'today': lambda now: now,
+    'tomorrow': lambda now: now + timedelta(days=1),
+    'a month ago': lambda now: now - timedelta(days=30),
+    'a month from now': lambda now: now + timedelta(days=30),
+    'two weeks from now': lambda now: now + timedelta(days=14),
+}
 
 class InvalidDate(Exception):
     pass
@@ -90,14 +126,24 @@ def parse_options(command_text):
     return command_text.replace(sc, '').strip()
 
 
+def now_eastern():
+    return _UTC.localize(datetime.utcnow()).astimezone(_EASTERN)
+
+
+def today_str():
+    """
+    Return the current date in US/Eastern as a YYYY-MM-DD string, without
+    going through the natural language date parser.
+    """
+    return str(now_eastern().date())
+
+
 def parse_date(date_str):
-    cal = pdt.Calendar()
-    
-    eastern = timezone('US/Eastern')
-    utc = timezone('UTC')
-    source_time = utc.localize(datetime.utcnow()).astimezone(eastern)
+    key = date_str.strip().lower()
+    if key in _FAST_DATES:
+        return str(_FAST_DATES[key](now_eastern()).date())
 
-    parsed_date_result = cal.parseDT(date_str, sourceTime=source_time)
+    parsed_date_result = _CAL.parseDT(date_str, sourceTime=now_eastern())
 
     if parsed_date_result[1] > 0:
         parsed_date = parsed_date_result[0]
@@ -110,69 +156,121 @@ def parse_date(date_str):
         return str(parsed_date.date())
 
 
+_CACHE = {}
+
+
+def cached(key, ttl, fn):
+    """
+    Return the result of FN, reusing a value cached under KEY if it was
+    computed less than TTL seconds ago.
+    """
+    value, expiry = _CACHE.get(key, (None, 0))
+    if time.time() < expiry:
+        return value
+    value = fn()
+    _CACHE[key] = (value, time.time() + ttl)
+    return value
+
+
+def invalidate_cache():
+    # This only clears the cache in the current container. Status writes run in
+    # the Zappa async task, which may not be the container answering /iam today,
+    # so reads can still be up to one TTL stale after a write.
+    _CACHE.clear()
+
+
+def status_item(user_id, the_date, the_status, user_name=None):
+    item = {
+        'user_id': user_id,
+        'date': the_date,
+        'status': the_status,
+        'user_name': user_name
+    }
+    # status_key is only set for WFH/OOO rows so status-date-index stays sparse
+    if the_status in WFH_OOO:
+        item['status_key'] = the_status
+    return item
+
+
 def submit_status(user_id, the_date, the_status, user_name=None):
-    log_table = dynamo.Table(log_table_name)
-    log_table.put_item(
-        Item={
-            'user_id': user_id,
-            'date': the_date,
-            'status': the_status,
-            'user_name': user_name
-        }
-    ) 
+    submit_statuses(user_id, [the_date], the_status, user_name)
+
+
+def submit_statuses(user_id, dates, the_status, user_name=None):
+    # overwrite_by_pkeys de-duplicates repeated dates, which BatchWriteItem rejects
+    with _LOG_TABLE.batch_writer(overwrite_by_pkeys=['user_id', 'date']) as batch:
+        for the_date in dates:
+            batch.put_item(
+                Item=status_item(user_id, the_date, the_status, user_name)
+            )
+    invalidate_cache()
+
+
+def read_all(read, **read_kwargs):
+    """
+    Call the table method READ (e.g. `_LOG_TABLE.query` or `_LOG_TABLE.scan`),
+    following LastEvaluatedKey until every page has been read, and return the
+    combined list of items.
+    """
+    items = []
+    while True:
+        response = read(**read_kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        read_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 
 def get_todays_status():
-    log_table = dynamo.Table(log_table_name)
-    response = log_table.query(
+    return cached(('today', today_str()), 60, _get_todays_status)
+
+
+def _get_todays_status():
+    all_statuses = read_all(
+        _LOG_TABLE.query,
         IndexName='date-index',
-        KeyConditionExpression=Key('date').eq(parse_date('today'))
+        KeyConditionExpression=Key('date').eq(today_str()),
+        FilterExpression=Attr('status').is_in(list(WFH_OOO))
     )
-    all_statuses = response['Items']
 
-    todays_statuses = sorted([
-        f"{stat['user_name']} - {stat['status'].upper()}" 
-        for stat in all_statuses 
-        if stat['status'].lower() in ['wfh', 'ooo']
-    ])
+    # user_name can be NULL; str() keeps those rows sortable and renders them as before
+    rows = [(str(stat.get('user_name')), stat['status'].upper()) for stat in all_statuses]
+    rows.sort()
 
-    return '\n'.join(todays_statuses)
+    return '\n'.join(f"{u} - {s}" for u, s in rows)
 
 
 def get_history(user_id):
-    log_table = dynamo.Table(log_table_name)
-    response = log_table.query(
+    today = today_str()
+    all_statuses = read_all(
+        _LOG_TABLE.query,
         KeyConditionExpression=(
             Key('user_id').eq(user_id) &
-            Key('date').gte(parse_date('a month ago')) 
-        )
+            Key('date').between(parse_date('a month ago'), today)
+        ),
+        FilterExpression=Attr('status').is_in(list(WFH_OOO))
     )
-    all_statuses = response['Items']
 
-    past_statuses = sorted([
-        f"{stat['date']} - {stat['status'].upper()}" 
-        for stat in all_statuses 
-        if stat['status'].lower() in ['wfh', 'ooo']
-        and stat['date'] <= parse_date('today')
-    ])
+    rows = [(stat['date'], stat['status'].upper()) for stat in all_statuses]
+    rows.sort()
 
-    return '\n'.join(past_statuses)
+    return '\n'.join(f"{d} - {s}" for d, s in rows)
 
 
 def parse_date_options(opts):
+    """
+    Parse the dates given in OPTS, returning a tuple (kind, dates) where kind
+    is 'and' for a list of dates, 'through' for a date range, or 'single'.
+    """
+    if _AND_RE.search(opts):
 
-    if ' and ' in opts.lower():
-
-        date_opts = opts.lower().split(' and ')
-
-    elif any(tw in opts.lower() for tw in through_words):
+        kind = 'and'
+        date_opts = _AND_RE.split(opts)
 
-        for tw in through_words:
-            if tw in opts.lower():
-                split_word = tw 
-                break
+    elif _THROUGH_RE.search(opts):
 
-        end_dates = opts.lower().split(split_word)
+        kind = 'through'
+        end_dates = _THROUGH_RE.split(opts)
 
         assert len(end_dates) == 2, "Must provide a start and end date, e.g. 'monday through friday'"
 
@@ -183,73 +281,81 @@ def parse_date_options(opts):
 
         assert start_date <= end_date, "First date in range must come before the end date."
 
-        dates = []
-        
-        while start_date <= end_date:
-            dates.append(str(start_date.date()))
-            start_date = start_date + timedelta(days=1)
-        
-        date_opts = dates
+        # These are already YYYY-MM-DD strings, so they skip the final parse below
+        return kind, [
+            str((start_date + timedelta(days=i)).date())
+            for i in range((end_date - start_date).days + 1)
+        ]
 
     else:
+        kind = 'single'
         date_opts = [opts]
 
-    return [parse_date(date_opt) for date_opt in date_opts]
+    return kind, [parse_date(date_opt) for date_opt in date_opts]
 
 
 def get_schedule():
-    log_table = dynamo.Table(log_table_name)
-    response = log_table.scan()
-    all_statuses = response['Items']
+    return cached(('schedule', today_str()), 30, _get_schedule)
+
 
-    start_date = parse_date('today')
+def _get_schedule():
+
+    start_date = today_str()
     end_date = parse_date('a month from now')
 
-    future_statuses = sorted([
-        f"{stat['date']} - {stat['user_name']} - {stat['status'].upper()}" 
-        for stat in all_statuses 
-        if stat['status'].lower() in ['wfh', 'ooo']
-        and stat['date'] >= start_date
-        and stat['date'] <= end_date
-    ])
+    all_statuses = []
+    for status in WFH_OOO:
+        all_statuses.extend(read_all(
+            _LOG_TABLE.query,
+            IndexName='status-date-index',
+            KeyConditionExpression=(
+                Key('status_key').eq(status) &
+                Key('date').between(start_date, end_date)
+            )
+        ))
+
+    rows = [
+        (stat['date'], str(stat.get('user_name')), stat['status'].upper())
+        for stat in all_statuses
+    ]
+    rows.sort()
 
-    return '\n'.join(future_statuses)
+    return '\n'.join(f"{d} - {u} - {s}" for d, u, s in rows)
 
 
 @task
 def log_time_task(response_url, subcommand, options, user_id, user_name):
 
-    time.sleep(3)
-
     try:
         if len(options) == 0:
             options = 'today'
         
-        the_dates = parse_date_options(options)
+        kind, the_dates = parse_date_options(options)
 
-        for the_date in the_dates:
-            submit_status(user_id, the_date, subcommand, user_name)
+        submit_statuses(user_id, the_dates, subcommand, user_name)
 
         if len(the_dates) == 1: 
         
-            if the_date > parse_date('today'):
+            the_date = the_dates[0]
+            today = today_str()
+            if the_date > today:
                 response_text = f'{user_name} will be {subcommand.upper()} on {the_date}.'
-            elif the_date == parse_date('today'):
+            elif the_date == today:
                 response_text = f'{user_name} is {subcommand.upper()} today.'
             else:
                 response_text = f'{user_name} was {subcommand.upper()} on {the_date}.'
 
-        elif ' and ' in options.lower():
+        elif kind == 'and':
 
             response_text = f'{user_name} is {subcommand.upper()} on '
             response_text += ' and '.join(the_dates)
 
-        elif any(tw in options.lower() for tw in through_words):
+        elif kind == 'through':
             response_text = f'{user_name} is {subcommand.upper()} on {the_dates[0]} through {the_dates[-1]}'
         else:
             raise Exception("Something went wrong!")
     except:
-        requests.post(response_url,
+        _SESSION.post(response_url,
             json={
                 'response_type': 'ephemeral',
                 'text': 'Oops, something went wrong!',
@@ -258,124 +364,143 @@ def log_time_task(response_url, subcommand, options, user_id, user_name):
                 ] 
             }
         )
+    else:
+        _SESSION.post(response_url, 
+            json={
+                'response_type': 'in_channel',
+                'text': response_text
+            }
+        )
 
-    requests.post(response_url, 
-        json={
-            'response_type': 'in_channel',
-            'text': response_text
-        }
-    )
-
-
-@app.route('/iam', methods=['POST'])
-def iam():
-    if not is_request_valid(request):
-        abort(400)
 
-    request_text = request.form['text']
+def _do_log(subcommand, options, user_id, user_name, response_url):
+    # Use an async response just to prevent the command getting written to the channel for all to see
+    log_time_task(response_url, subcommand, options, user_id, user_name)
 
-    subcommand = parse_subcommand(request_text)
-    options = parse_options(request_text)
+    return jsonify(
+        response_type='ephemeral',
+        text="logging..."
+    )
 
-    user_id = request.form['user_id']
-    user_name = request.form['user_name']
 
-    if subcommand == 'wfh' or subcommand == 'ooo' or subcommand == 'in':
+def _do_help(subcommand, options, user_id, user_name, response_url):
+    return jsonify(
+        text=help_text,
+        attachments=[
+            dict(text=help_attachment_text),
+        ]
+    )
 
-        # Use an async response just to prevent the command getting written to the channel for all to see
-        log_time_task(request.form['response_url'], subcommand, options, user_id, user_name)
 
+def _do_schedule(subcommand, options, user_id, user_name, response_url):
+    try:
+        future_statuses = get_schedule()
+    except:
         return jsonify(
             response_type='ephemeral',
-            text="logging..."
-        )
-
-    elif subcommand == 'help':
-        return jsonify(
-            text=help_text,
+            text="Oops! Something went wrong!",
             attachments=[
-                dict(text=help_attachment_text),
+                dict(text=format_exc()),
             ]
         )
+    
+    return jsonify(
+        response_type='in_channel',
+        text="Upcoming WFH/OOO statuses:",
+        attachments=[
+            dict(text=future_statuses),
+        ]
+    ) 
 
-    elif subcommand == 'schedule':
-        try:
-            future_statuses = get_schedule()
-        except:
-            return jsonify(
-                response_type='ephemeral',
-                text="Oops! Something went wrong!",
-                attachments=[
-                    dict(text=format_exc()),
-                ]
-            )
-        
-        return jsonify(
-            response_type='in_channel',
-            text="Upcoming WFH/OOO statuses:",
-            attachments=[
-                dict(text=future_statuses),
-            ]
-        ) 
 
-    elif subcommand == 'today':
-        try:
-            todays_statuses = get_todays_status()
-            if len(todays_statuses) == 0:
-                todays_statuses = 'Everyone is planning to be in office today.'
-        except:
-            return jsonify(
-                response_type='ephemeral',
-                text="Oops! Something went wrong!",
-                attachments=[
-                    dict(text=format_exc()),
-                ]
-            )
+def _do_today(subcommand, options, user_id, user_name, response_url):
+    try:
+        todays_statuses = get_todays_status()
+        if len(todays_statuses) == 0:
+            todays_statuses = 'Everyone is planning to be in office today.'
+    except:
         return jsonify(
-            response_type='in_channel',
-            text="Today's WFH/OOO statuses:",
+            response_type='ephemeral',
+            text="Oops! Something went wrong!",
             attachments=[
-                dict(text=todays_statuses),
+                dict(text=format_exc()),
             ]
         )
+    return jsonify(
+        response_type='in_channel',
+        text="Today's WFH/OOO statuses:",
+        attachments=[
+            dict(text=todays_statuses),
+        ]
+    )
 
-    elif subcommand == 'history':
-        try:
-            past_statuses = get_history(user_id)
-        except:
-            return jsonify(
-                response_type='ephemeral',
-                text="Oops! Something went wrong!",
-                attachments=[
-                    dict(text=format_exc()),
-                ]
-            ) 
+
+def _do_history(subcommand, options, user_id, user_name, response_url):
+    try:
+        past_statuses = get_history(user_id)
+    except:
         return jsonify(
-            text="My WFH/OOO status from the past month:",
+            response_type='ephemeral',
+            text="Oops! Something went wrong!",
             attachments=[
-                dict(text=past_statuses),
+                dict(text=format_exc()),
             ]
-        )
+        ) 
+    return jsonify(
+        text="My WFH/OOO status from the past month:",
+        attachments=[
+            dict(text=past_statuses),
+        ]
+    )
 
-    elif subcommand == 'version':
-        return jsonify(
-            text=VERSION
-        )      
 
-    else:
-        return jsonify(
-            text="Unknown subcommand!",
-            attachments=[
-                dict(text=help_attachment_text),
-            ]
-        )
+def _do_version(subcommand, options, user_id, user_name, response_url):
+    return jsonify(
+        text=VERSION
+    )      
+
+
+def _do_unknown(subcommand, options, user_id, user_name, response_url):
+    return jsonify(
+        text="Unknown subcommand!",
+        attachments=[
+            dict(text=help_attachment_text),
+        ]
+    )
+
+
+HANDLERS = {
+    'wfh': _do_log,
+    'ooo': _do_log,
+    'in': _do_log,
+    'help': _do_help,
+    'schedule': _do_schedule,
+    'today': _do_today,
+    'history': _do_history,
+    'version': _do_version,
+}
+
+
+@app.route('/iam', methods=['POST'])
+def iam():
+    if not is_request_valid(request):
+        abort(400)
+
+    request_text = request.form['text']
+
+    subcommand = parse_subcommand(request_text)
+    options = parse_options(request_text)
+
+    user_id = request.form['user_id']
+    user_name = request.form['user_name']
+
+    handler = HANDLERS.get(subcommand, _do_unknown)
+    return handler(subcommand, options, user_id, user_name, request.form['response_url'])
 
 
 def daily_update():
 
-    eastern = timezone('US/Eastern')
-    utc = timezone('UTC')
-    eastern_time = utc.localize(datetime.utcnow()).astimezone(eastern).time()
+    eastern_time = now_eastern().time()
     if eastern_time < dt_time(8,50) or eastern_time > dt_time(9,10):
         return
 
@@ -390,12 +515,52 @@ def daily_update():
 
     body['attachments'] = [{'text': todays_statuses, 'mrkdwn_in': ['text']}]
 
-    requests.post(
-        webhook_url, 
-        json=body,
-        headers={'Content-Type': 'application/json'}
-    )
+    # Bound the wait so a hung webhook can't hold the Lambda until its own timeout,
+    # but allow enough time for normal Slack latency
+    try:
+        _SESSION.post(
+            webhook_url, 
+            json=body,
+            timeout=(3.05, 5)
+        )
+    except requests.exceptions.Timeout:
+        # Delivery is unknown; log the payload and fail the invocation so Lambda retries it
+        logger.error(f'Timed out posting the daily update to Slack: {json.dumps(body)}')
+        raise
+
+
+def backfill_status_keys():
+    """
+    One-off migration that sets status_key on every stored WFH/OOO row, so rows
+    logged before status-date-index existed show up in the schedule. Each update
+    only applies if the row's status is unchanged since the scan, so it is safe
+    to re-run while the app is live.
+    """
+    count = 0
+    for stat in read_all(
+        _LOG_TABLE.scan,
+        FilterExpression=Attr('status').is_in(list(WFH_OOO))
+    ):
+        try:
+            _LOG_TABLE.update_item(
+                Key={'user_id': stat['user_id'], 'date': stat['date']},
+                UpdateExpression='SET status_key = :s',
+                ConditionExpression=Attr('status').eq(stat['status']),
+                ExpressionAttributeValues={':s': stat['status']}
+            )
+        except ClientError as e:
+            # The status was changed by a live write after the scan read it
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            continue
+        count += 1
+
+    logger.info(f'Backfilled status_key on {count} rows')
 
 
 if __name__ == '__main__':
-    daily_update()
+    # `python iam.py backfill` runs the status_key migration; otherwise send the daily update
+    if sys.argv[1:] == ['backfill']:
+        backfill_status_keys()
+    else:
+        daily_update()